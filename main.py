@@ -1,19 +1,33 @@
 import os
 import io
 import zipfile
-import base64
 import asyncio
+import hashlib
+import json
 import logging
-from typing import List, Tuple
+import random
+import re
+import tempfile
+import time
+from collections import OrderedDict, deque
+from typing import BinaryIO, Deque, Dict, List, Optional, Tuple
 from datetime import datetime
 
-from telegram import Update, Bot
+import httpx
+from telegram import Update, Bot, Message
 from telegram.ext import Application, CommandHandler, MessageHandler, filters, ContextTypes
 from telegram.constants import ParseMode
-from openai import AsyncOpenAI
-from PIL import Image
+from telegram.error import TelegramError
+from openai import AsyncOpenAI, APIConnectionError, APIError, APITimeoutError, InternalServerError, RateLimitError
+from PIL import ExifTags, Image, ImageChops, ImageOps, ImageSequence
+import pybase64
 from dotenv import load_dotenv
 
+try:
+    import uvloop
+except ImportError:  # uvloop не поддерживает Windows
+    uvloop = None
+
 # Загружаем переменные окружения
 load_dotenv()
 
@@ -25,41 +39,57 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # Инициализация клиентов
-openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+# HTTP/2 мультиплексирует параллельные запросы к OpenAI в одном TLS соединении
+openai_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(60.0, connect=10.0),
+    limits=httpx.Limits(max_connections=64, max_keepalive_connections=32)
+)
+# Повторы выполняет ImageAnalyzer.create_completion, чтобы каждая попытка проходила через лимиты запросов
+openai_client = AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), http_client=openai_http_client, max_retries=0)
 
 # Константы
 MAX_FILE_SIZE = 20 * 1024 * 1024  # 20MB
+MAX_IMAGE_SIZE = 20 * 1024 * 1024  # Максимальный размер одного изображения после распаковки
+ZIP_SPOOL_MAX_SIZE = 8 * 1024 * 1024  # Архивы больше этого размера при скачивании сбрасываются на диск
+STATUS_UPDATE_INTERVAL = 1.5  # Минимальный интервал между обновлениями статуса, секунды
 SUPPORTED_FORMATS = {'.jpg', '.jpeg', '.png', '.gif'}
+# Сигнатуры (magic bytes) поддерживаемых форматов: JPEG, PNG, GIF
+IMAGE_SIGNATURES = (b'\xff\xd8\xff', b'\x89PNG\r\n\x1a\n', b'GIF87a', b'GIF89a')
+IMAGE_HEADER_SIZE = 16  # Сколько байт читать из архива для проверки сигнатуры
 MAX_GIF_FRAMES = 5  # Максимум кадров для анализа в GIF
+DHASH_SIZE = 16  # Сторона сетки перцептивного хэша: 16x16 бит
+DHASH_MAX_DISTANCE = 16  # Сколько бит dHash может отличаться у кандидатов в повторы
+DEDUP_THUMB_SIZE = 32  # Сторона цветной уменьшенной копии для подтверждения повтора
+DEDUP_PIXEL_TOLERANCE = 16  # Допустимое отличие канала пикселя уменьшенных копий у повторов
+MAX_IMAGE_SIDE = 512  # Максимальная сторона изображения: в режиме low модель видит одну плитку 512x512
+IMAGE_DETAIL = "low"  # Режим детализации Vision API, фиксированная стоимость изображения
+JPEG_QUALITY = 80  # Качество JPEG при пережатии изображений
+MAX_CONCURRENT_REQUESTS = max(1, int(os.getenv('MAX_CONCURRENT_REQUESTS', '5')))  # Начальный лимит одновременных запросов к OpenAI
+CONCURRENCY_MAX = 32  # Верхняя граница лимита одновременных запросов при автоподстройке
+CONCURRENCY_TARGET_LATENCY = 15  # Пока средний ответ быстрее, лимит одновременных запросов растет, секунды
+IMAGES_PER_REQUEST = int(os.getenv('IMAGES_PER_REQUEST', '5'))  # Сколько статичных изображений анализировать одним запросом
+ANALYSIS_CACHE_SIZE = 1024  # Максимум результатов анализа в памяти
+ANALYSIS_CACHE_DIR = os.getenv('ANALYSIS_CACHE_DIR', '/tmp/img_cache')  # Кэш на диске между перезапусками
+ANALYSIS_CACHE_MAX_FILES = 10000  # Максимум результатов анализа на диске
+ANALYSIS_CACHE_MAX_AGE = 30 * 24 * 3600  # Срок хранения результата на диске, секунды
+ANALYSIS_CACHE_PRUNE_EVERY = 100  # Чистка кэша на диске после каждых N записей
 
-class ImageAnalyzer:
-    def __init__(self):
-        self.openai_client = openai_client
+OPENAI_MODEL = "gpt-4o-mini"
+BATCH_ENDPOINT = "/v1/chat/completions"  # Эндпоинт для запросов OpenAI Batch API
+BATCH_POLL_INTERVAL = 60  # Интервал опроса статуса пакетного задания, секунды
+ANALYSIS_MAX_TOKENS = 200  # Ответ по критериям а-д укладывается в несколько строк
+OPENAI_REQUEST_TIMEOUT = 30  # Таймаут одной попытки запроса к OpenAI, секунды
+OPENAI_MAX_RETRIES = 5  # Количество попыток при зависании запроса, 429 и ошибках сервера
+OPENAI_MAX_BACKOFF = 30  # Максимальная пауза между попытками, секунды
+OPENAI_MAX_REQUESTS_PER_MINUTE = max(1, int(os.getenv('OPENAI_MAX_REQUESTS_PER_MINUTE', '500')))  # Лимит RPM тарифа
+OPENAI_MAX_TOKENS_PER_MINUTE = max(1, int(os.getenv('OPENAI_MAX_TOKENS_PER_MINUTE', '200000')))  # Лимит TPM тарифа
+IMAGE_TOKEN_ESTIMATE = 85  # Токены изображения в режиме low
+RATE_LIMIT_DURATION_RE = re.compile(r'(\d+(?:\.\d+)?)(ms|s|m|h)')  # Формат x-ratelimit-reset-*: "6m0s", "20ms"
+RATE_LIMIT_DURATION_UNITS = {'ms': 0.001, 's': 1, 'm': 60, 'h': 3600}
 
-    async def analyze_image(self, image_data: bytes, filename: str) -> str:
-        """Анализирует изображение с помощью OpenAI Vision API по заданным критериям"""
-        try:
-            # Проверяем, является ли файл GIF
-            if filename.lower().endswith('.gif'):
-                frames = self.extract_gif_frames(image_data)
-                if frames:
-                    return await self.analyze_gif_frames(frames, filename)
-                else:
-                    return "Ошибка: не удалось извлечь кадры из GIF файла"
-            
-            # Для обычных изображений (JPG, PNG)
-            # Конвертируем изображение в base64
-            base64_image = base64.b64encode(image_data).decode('utf-8')
-            
-            response = await self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {
-                                "type": "text",
-                                "text": """Проанализируйте изображение по следующим критериям и дайте краткие ответы на русском языке:
+# Промпт для статичных изображений
+IMAGE_ANALYSIS_PROMPT = """Проанализируйте изображение по следующим критериям и дайте краткие ответы на русском языке:
 
 а. Есть ли на картинке реалистичное фото? (да/нет)
 б. Есть ли на картинке иллюстрация? (да/нет) 
@@ -73,61 +103,613 @@ class ImageAnalyzer:
 в. [ответ]
 г. [ответ]
 д. [ответ]"""
-                            },
-                            {
-                                "type": "image_url",
-                                "image_url": {
-                                    "url": f"data:image/jpeg;base64,{base64_image}"
-                                }
-                            }
-                        ]
-                    }
-                ],
-                max_tokens=200
+
+# Текстовая часть запроса для статичных изображений одна на все запросы, SDK ее не изменяет
+IMAGE_PROMPT_PART = {"type": "text", "text": IMAGE_ANALYSIS_PROMPT}
+
+# Промпт для нескольких статичных изображений в одном запросе, перед каждым изображением идет его номер
+MULTI_IMAGE_ANALYSIS_PROMPT = """Перед вами {image_count} изображений, перед каждым указан его номер. Проанализируйте каждое изображение отдельно по следующим критериям и дайте краткие ответы на русском языке:
+
+а. Есть ли на картинке реалистичное фото? (да/нет)
+б. Есть ли на картинке иллюстрация? (да/нет) 
+в. Что изображено на картинке крупнее всего: люди или какие именно предметы?
+г. Каков основной цвет фона?
+д. Содержится ли на картинке сообщение о скидке или выгоде? (да/нет)
+
+Ответьте строго по формату, отдельным блоком для каждого изображения по порядку:
+Изображение 1
+а. [ответ]
+б. [ответ]
+в. [ответ]
+г. [ответ]
+д. [ответ]
+Изображение 2
+а. [ответ]
+..."""
+
+# Заголовок блока ответа на одно изображение в совместном запросе
+MULTI_IMAGE_HEADER_RE = re.compile(r'^\W*Изображение\s+(\d+)\b[^\n]*$', re.MULTILINE)
+
+# Промпт для GIF: все ключевые кадры отправляются в одном запросе
+GIF_ANALYSIS_PROMPT = """Перед вами {frame_count} ключевых кадров одной GIF анимации. Проанализируйте анимацию целиком по следующим критериям, учитывая доминирующие характеристики по всем кадрам. ВАЖНО: игнорируйте любые дисклеймеры, юридические уведомления, мелкий текст с правовой информацией, предупреждения о рисках.
+
+а. Есть ли на картинке реалистичное фото? (да/нет)
+б. Есть ли на картинке иллюстрация? (да/нет) 
+в. Что изображено на картинке крупнее всего: люди или какие именно предметы?
+г. Каков основной цвет фона?
+д. Содержится ли на картинке сообщение о скидке или выгоде? (да/нет, игнорируйте юридические дисклеймеры)
+
+Дайте один общий ответ по всем кадрам строго по формату:
+а. [ответ]
+б. [ответ]
+в. [ответ]
+г. [ответ]
+д. [ответ]"""
+
+# Версия кэша: результат зависит от модели, промптов и параметров изображений,
+# поэтому при их изменении старые записи перестают находиться
+ANALYSIS_CACHE_VERSION = hashlib.sha256(
+    json.dumps([
+        OPENAI_MODEL, IMAGE_ANALYSIS_PROMPT, MULTI_IMAGE_ANALYSIS_PROMPT, GIF_ANALYSIS_PROMPT,
+        MAX_IMAGE_SIDE, IMAGE_DETAIL, MAX_GIF_FRAMES, JPEG_QUALITY
+    ]).encode('utf-8')
+).hexdigest()[:16]
+
+# Строка ответа модели вида "а. [ответ]"
+ANALYSIS_LINE_RE = re.compile(r'^\s*([абвгд])\.(.*)$', re.MULTILINE)
+
+# Начало строки критерия в таблице результатов
+ANALYSIS_ITEM_PREFIX_RE = re.compile(r'[абвгд]\.')
+
+# Критерии с ответом да/нет и соответствующие поля результата
+YES_NO_FIELDS = {'а': 'realistic_photo', 'б': 'illustration', 'д': 'discount_message'}
+
+# Ключевые слова для определения основного объекта (проверяются по порядку)
+OBJECT_KEYWORDS = (
+    (('люди', 'человек'), 'people'),
+    (('телефон', 'компьютер', 'машина', 'автомобиль'), 'tech'),
+    (('еда', 'продукт', 'товар', 'одежда'), 'product'),
+)
+
+COLORS_MAP = {
+    'белый': 'white', 'черный': 'black', 'красный': 'red',
+    'синий': 'blue', 'зеленый': 'green', 'желтый': 'yellow',
+    'серый': 'gray', 'коричневый': 'brown', 'розовый': 'pink'
+}
+
+# Символы, удаляемые из исходного имени файла (остаются буквы, цифры, "-" и "_")
+FILENAME_DISALLOWED_RE = re.compile(r'[^\w-]')
+
+# Разделитель между результатами в таблице
+RESULTS_SEPARATOR = "─" * 40 + "\n\n"
+
+# Таблица экранирования спецсимволов Markdown для str.translate
+MARKDOWN_ESCAPE_TABLE = str.maketrans({char: f'\\{char}' for char in '_*[]()~`>#+-=|{}.!'})
+
+class RateLimiter:
+    """Скользящее окно в одну минуту для лимитов OpenAI по запросам и токенам"""
+
+    def __init__(self, max_requests_per_minute: int, max_tokens_per_minute: int):
+        self.max_requests = max_requests_per_minute
+        self.max_tokens = max_tokens_per_minute
+        self.window: Deque[Tuple[float, int]] = deque()  # (время запроса, оценка токенов)
+        self.tokens_in_window = 0
+        self.blocked_until = 0.0  # Пауза по заголовкам ответа, когда лимит уже исчерпан
+        self.lock = asyncio.Lock()
+
+    def expire(self, now: float):
+        """Убирает из окна запросы старше минуты"""
+        while self.window and now - self.window[0][0] >= 60:
+            _, tokens = self.window.popleft()
+            self.tokens_in_window -= tokens
+
+    async def wait_if_throttled(self, tokens: int):
+        """Ждет, пока запрос с указанным числом токенов поместится в лимиты, и учитывает его"""
+        # Ожидающие запросы проходят по очереди, иначе все они проснутся одновременно
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.expire(now)
+                delay = self.blocked_until - now
+                if delay <= 0:
+                    fits_tokens = not self.window or self.tokens_in_window + tokens <= self.max_tokens
+                    if len(self.window) < self.max_requests and fits_tokens:
+                        self.window.append((now, tokens))
+                        self.tokens_in_window += tokens
+                        return
+                    # Ждем, пока самый старый запрос выйдет из окна
+                    delay = self.window[0][0] + 60 - now
+                await asyncio.sleep(delay)
+
+    def update_from_headers(self, headers):
+        """Ставит паузу до сброса лимита, если по заголовкам ответа он исчерпан"""
+        for kind in ('requests', 'tokens'):
+            if headers.get(f'x-ratelimit-remaining-{kind}') != '0':
+                continue
+            reset = headers.get(f'x-ratelimit-reset-{kind}', '')
+            delay = sum(
+                float(value) * RATE_LIMIT_DURATION_UNITS[unit]
+                for value, unit in RATE_LIMIT_DURATION_RE.findall(reset)
             )
+            self.blocked_until = max(self.blocked_until, time.monotonic() + delay)
+
+class ConcurrencyController:
+    """Лимит одновременных запросов с автоподстройкой (AIMD): растет, пока ответы быстрые, и падает вдвое при перегрузке"""
+
+    def __init__(self, initial: int, minimum: int = 1, maximum: int = CONCURRENCY_MAX,
+                 increase: float = 0.5, decrease: float = 0.5, target_latency: float = CONCURRENCY_TARGET_LATENCY):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.increase = increase
+        self.decrease = decrease
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.latencies: Deque[float] = deque(maxlen=10)  # Время последних успешных ответов
+        self.last_decrease = 0.0  # Момент последнего снижения лимита (time.monotonic)
+        self.condition = asyncio.Condition()
+
+    async def __aenter__(self):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_flight < int(self.limit))
+            self.in_flight += 1
+
+    async def __aexit__(self, *exc_info):
+        async with self.condition:
+            self.in_flight -= 1
+            # Лимит мог вырасти, поэтому будим всех ожидающих
+            self.condition.notify_all()
+
+    def record_latency(self, latency: float):
+        """Учитывает успешный ответ: при средней задержке не выше целевой увеличивает лимит"""
+        self.latencies.append(latency)
+        if sum(self.latencies) / len(self.latencies) <= self.target_latency:
+            self.limit = min(self.maximum, self.limit + self.increase)
+
+    def record_overload(self, started: float):
+        """Учитывает 429, ошибку сервера или таймаут запроса, начатого в момент started: уменьшает лимит"""
+        # Запросы, начатые до прошлого снижения, относятся к уже учтенной перегрузке
+        if started < self.last_decrease:
+            return
+        self.limit = max(self.minimum, self.limit * self.decrease)
+        self.last_decrease = time.monotonic()
+        self.latencies.clear()
+        logger.info(f"Лимит одновременных запросов к OpenAI снижен до {int(self.limit)}")
+
+class ImageAnalyzer:
+    def __init__(self):
+        self.openai_client = openai_client
+        # Лимиты тарифа OpenAI по запросам и токенам в минуту
+        self.rate_limiter = RateLimiter(OPENAI_MAX_REQUESTS_PER_MINUTE, OPENAI_MAX_TOKENS_PER_MINUTE)
+        # Общий лимит одновременных запросов к OpenAI, подстраивается под задержки и ошибки
+        self.concurrency = ConcurrencyController(MAX_CONCURRENT_REQUESTS)
+        # LRU кэш результатов анализа по SHA-256 содержимого изображения
+        self.analysis_cache: OrderedDict[str, str] = OrderedDict()
+        self.disk_cache_writes = 0  # Счетчик записей на диск для периодической чистки
+
+    def completion_params(self, messages: List[dict], max_tokens: int = ANALYSIS_MAX_TOKENS) -> dict:
+        """Возвращает параметры запроса анализа, общие для обычного и пакетного режима"""
+        return {
+            "model": OPENAI_MODEL,
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": 0
+        }
+
+    def estimate_tokens(self, messages: List[dict], max_tokens: int) -> int:
+        """Грубо оценивает токены запроса для лимита TPM"""
+        tokens = max_tokens
+        for message in messages:
+            for part in message['content']:
+                if part['type'] == 'text':
+                    # Русский текст в среднем занимает около токена на 2 символа
+                    tokens += len(part['text']) // 2
+                else:
+                    tokens += IMAGE_TOKEN_ESTIMATE
+        return tokens
+
+    async def create_completion(self, messages: List[dict], max_tokens: int = ANALYSIS_MAX_TOKENS) -> str:
+        """Выполняет потоковый запрос к OpenAI с таймаутом и повторами, возвращает текст ответа"""
+        params = self.completion_params(messages, max_tokens)
+        tokens = self.estimate_tokens(messages, max_tokens)
+        
+        for attempt in range(OPENAI_MAX_RETRIES):
+            try:
+                await self.rate_limiter.wait_if_throttled(tokens)
+                async with self.concurrency, asyncio.timeout(OPENAI_REQUEST_TIMEOUT):
+                    started = time.monotonic()
+                    # Сырой ответ нужен ради заголовков x-ratelimit-*
+                    response = await self.openai_client.chat.completions.with_raw_response.create(
+                        **params, stream=True, timeout=OPENAI_REQUEST_TIMEOUT
+                    )
+                    self.rate_limiter.update_from_headers(response.headers)
+                    stream = response.parse()
+                    try:
+                        chunks = []
+                        async for chunk in stream:
+                            if chunk.choices and chunk.choices[0].delta.content:
+                                chunks.append(chunk.choices[0].delta.content)
+                        self.concurrency.record_latency(time.monotonic() - started)
+                        return "".join(chunks).strip()
+                    finally:
+                        await stream.close()
+                        
+            except (TimeoutError, APIConnectionError, httpx.TransportError, RateLimitError, InternalServerError) as e:
+                # Обрыв соединения (в том числе посреди потока) не говорит о перегрузке, лимит не снижаем
+                if isinstance(e, (TimeoutError, APITimeoutError, httpx.TimeoutException, RateLimitError, InternalServerError)):
+                    self.concurrency.record_overload(started)
+                if attempt == OPENAI_MAX_RETRIES - 1:
+                    raise
+                logger.warning(f"Запрос к OpenAI не удался (попытка {attempt + 1}/{OPENAI_MAX_RETRIES}): {e!r}")
+                # Случайная добавка разводит повторы параллельных запросов во времени
+                await asyncio.sleep(min(OPENAI_MAX_BACKOFF, 2 ** attempt + random.random()))
+
+    def prepare_image(self, image_data: bytes, img: Image.Image) -> bytes:
+        """Уменьшает изображение и пережимает в JPEG перед отправкой в OpenAI"""
+        with img:
+            # Небольшие JPEG без поворота в EXIF отправляем как есть
+            orientation = img.getexif().get(ExifTags.Base.Orientation, 1)
+            if img.format == 'JPEG' and max(img.size) <= MAX_IMAGE_SIDE and orientation == 1:
+                return image_data
+            
+            # Для JPEG декодер сразу распаковывает уменьшенную копию (1/2..1/8) из DCT-коэффициентов,
+            # для остальных форматов вызов ничего не делает
+            img.draft('RGB', (MAX_IMAGE_SIDE, MAX_IMAGE_SIDE))
+            # При пережатии EXIF теряется, поэтому поворот из него применяем к пикселям
+            ImageOps.exif_transpose(img, in_place=True)
+            # Сначала приводим к RGB: для палитровых изображений thumbnail использует NEAREST,
+            # и тонкие линии и мелкий текст пропадают
+            rgb = self.flatten_to_rgb(img)
+            rgb.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.BILINEAR)
+            
+            buffer = io.BytesIO()
+            rgb.save(buffer, format='JPEG', quality=JPEG_QUALITY)
+            return buffer.getvalue()
+
+    def flatten_to_rgb(self, img: Image.Image) -> Image.Image:
+        """Приводит изображение к RGB, заливая прозрачные области белым"""
+        if img.mode == 'RGB':
+            return img
+        
+        # Прозрачные области заливаем белым, иначе при конвертации в RGB они станут черными
+        if img.mode in ('RGBA', 'LA', 'P') and (img.mode != 'P' or 'transparency' in img.info):
+            rgba = img.convert('RGBA')
+            rgb = Image.new('RGB', rgba.size, 'white')
+            rgb.paste(rgba, mask=rgba.getchannel('A'))
+            return rgb
+        
+        return img.convert('RGB')
+
+    def image_data_url(self, image_data: bytes, mime_type: str) -> str:
+        """Кодирует изображение в data URL для Vision API"""
+        return f"data:{mime_type};base64,{pybase64.b64encode_as_string(image_data)}"
+
+    def cache_key(self, image_data: bytes) -> str:
+        """Возвращает ключ кэша: SHA-256 содержимого с учетом версии анализа"""
+        digest = hashlib.sha256(ANALYSIS_CACHE_VERSION.encode('ascii'))
+        digest.update(image_data)
+        return digest.hexdigest()
+
+    async def get_cached_analysis(self, key: str) -> Optional[str]:
+        """Возвращает сохраненный результат анализа из памяти или с диска"""
+        if key in self.analysis_cache:
+            self.analysis_cache.move_to_end(key)
+            return self.analysis_cache[key]
+        
+        analysis = await asyncio.to_thread(self.read_cache_file, key)
+        if analysis is not None:
+            self.remember_analysis(key, analysis)
+        return analysis
+
+    def read_cache_file(self, key: str) -> Optional[str]:
+        """Читает результат анализа с диска, устаревшие записи не возвращает"""
+        cache_path = os.path.join(ANALYSIS_CACHE_DIR, f"{key}.txt")
+        try:
+            if time.time() - os.path.getmtime(cache_path) > ANALYSIS_CACHE_MAX_AGE:
+                return None
+            with open(cache_path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def remember_analysis(self, key: str, analysis: str):
+        """Сохраняет результат анализа в LRU кэше в памяти"""
+        self.analysis_cache[key] = analysis
+        self.analysis_cache.move_to_end(key)
+        if len(self.analysis_cache) > ANALYSIS_CACHE_SIZE:
+            self.analysis_cache.popitem(last=False)
+
+    async def store_cached_analysis(self, key: str, analysis: str):
+        """Сохраняет результат анализа в памяти и на диске"""
+        self.remember_analysis(key, analysis)
+        # Чистим кэш при первой записи и затем после каждых ANALYSIS_CACHE_PRUNE_EVERY записей
+        prune = self.disk_cache_writes % ANALYSIS_CACHE_PRUNE_EVERY == 0
+        self.disk_cache_writes += 1
+        await asyncio.to_thread(self.write_cache_file, key, analysis, prune)
+
+    def write_cache_file(self, key: str, analysis: str, prune: bool):
+        """Записывает результат анализа на диск и при необходимости чистит кэш"""
+        try:
+            os.makedirs(ANALYSIS_CACHE_DIR, exist_ok=True)
+            with open(os.path.join(ANALYSIS_CACHE_DIR, f"{key}.txt"), 'w', encoding='utf-8') as f:
+                f.write(analysis)
+            if prune:
+                self.prune_disk_cache()
+        except OSError as e:
+            logger.warning(f"Не удалось сохранить анализ в кэш на диске: {e}")
+
+    def prune_disk_cache(self):
+        """Удаляет устаревшие записи и самые старые записи сверх ANALYSIS_CACHE_MAX_FILES"""
+        entries = []
+        with os.scandir(ANALYSIS_CACHE_DIR) as it:
+            for entry in it:
+                if entry.is_file() and entry.name.endswith('.txt'):
+                    entries.append((entry.stat().st_mtime, entry.path))
+        
+        entries.sort(reverse=True)
+        expire_before = time.time() - ANALYSIS_CACHE_MAX_AGE
+        for i, (mtime, path) in enumerate(entries):
+            if i >= ANALYSIS_CACHE_MAX_FILES or mtime < expire_before:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    async def analyze_image(self, image_data: bytes, filename: str, img: Optional[Image.Image] = None) -> str:
+        """Анализирует изображение, используя кэш результатов по содержимому файла"""
+        key = self.cache_key(image_data)
+        cached_analysis = await self.get_cached_analysis(key)
+        if cached_analysis is not None:
+            logger.info(f"Анализ {filename} взят из кэша")
+            return cached_analysis
+        
+        analysis = await self.request_analysis(image_data, filename, img)
+        # Кэшируем только ответы по формату: ошибки, пустые ответы и отказы
+        # не сохраняем, чтобы повторная загрузка могла их исправить
+        if ANALYSIS_LINE_RE.search(analysis):
+            await self.store_cached_analysis(key, analysis)
+        return analysis
+
+    async def build_analysis_messages(self, image_data: bytes, filename: str, img: Optional[Image.Image] = None) -> List[dict]:
+        """Готовит сообщения запроса к Vision API для изображения или GIF"""
+        # Используем уже открытое при валидации изображение, иначе открываем сами
+        if img is None:
+            img = Image.open(io.BytesIO(image_data))
+        
+        # Для GIF все ключевые кадры отправляем в одном запросе и сразу просим общий вывод.
+        # Декодирование и base64 выполняем в отдельном потоке, чтобы не блокировать event loop
+        if filename.lower().endswith('.gif'):
+            frames = await asyncio.to_thread(self.extract_gif_frames, img)
+            if not frames:
+                raise ValueError("не удалось извлечь кадры из GIF файла")
+            
+            content = [{"type": "text", "text": GIF_ANALYSIS_PROMPT.format(frame_count=len(frames))}]
+            for frame_data in frames:
+                frame_url = await asyncio.to_thread(self.image_data_url, frame_data, "image/jpeg")
+                content.append({"type": "image_url", "image_url": {"url": frame_url, "detail": IMAGE_DETAIL}})
+            return [{"role": "user", "content": content}]
+        
+        # Для обычных изображений (JPG, PNG) уменьшаем размер перед отправкой
+        return [{"role": "user", "content": [IMAGE_PROMPT_PART, await self.image_content_part(image_data, img)]}]
+
+    async def image_content_part(self, image_data: bytes, img: Optional[Image.Image] = None) -> dict:
+        """Уменьшает статичное изображение и возвращает часть запроса с ним"""
+        if img is None:
+            img = Image.open(io.BytesIO(image_data))
+        image_data = await asyncio.to_thread(self.prepare_image, image_data, img)
+        image_url = await asyncio.to_thread(self.image_data_url, image_data, "image/jpeg")
+        return {"type": "image_url", "image_url": {"url": image_url, "detail": IMAGE_DETAIL}}
+
+    async def analyze_images_batch(self, items: List[Tuple[str, bytes, Optional[Image.Image]]]) -> List[str]:
+        """Анализирует несколько изображений одним запросом, возвращает анализ для каждого по порядку"""
+        keys = [self.cache_key(image_data) for _, image_data, _ in items]
+        results: List[Optional[str]] = [await self.get_cached_analysis(key) for key in keys]
+        # GIF отправляются кадрами, поэтому их анализируем отдельными запросами
+        pending = [
+            i for i, (filename, _, _) in enumerate(items)
+            if results[i] is None and not filename.lower().endswith('.gif')
+        ]
+        batched = pending if len(pending) > 1 else []
+        individual = [i for i, result in enumerate(results) if result is None and i not in batched]
+        
+        # Общий запрос и отдельные запросы для GIF выполняются параллельно
+        answers, *analyses = await asyncio.gather(
+            self.request_multi_analysis([items[i] for i in batched]),
+            *(self.analyze_image(items[i][1], items[i][0], items[i][2]) for i in individual)
+        )
+        for i, analysis in zip(individual, analyses):
+            results[i] = analysis
+        
+        for number, i in enumerate(batched):
+            if number in answers:
+                results[i] = answers[number]
+                await self.store_cached_analysis(keys[i], answers[number])
+            else:
+                logger.warning(f"Нет ответа для {items[i][0]} в совместном запросе, анализируем отдельно")
+        
+        # Изображения без ответа в общем запросе анализируем по одному.
+        # Они уже закрыты, поэтому открываются заново из данных
+        missing = [i for i in batched if results[i] is None]
+        analyses = await asyncio.gather(*(self.analyze_image(items[i][1], items[i][0]) for i in missing))
+        for i, analysis in zip(missing, analyses):
+            results[i] = analysis
+        return results
+
+    async def request_multi_analysis(self, items: List[Tuple[str, bytes, Optional[Image.Image]]]) -> Dict[int, str]:
+        """Анализирует статичные изображения одним запросом, возвращает ответы по номерам (с нуля)"""
+        if not items:
+            return {}
+        
+        try:
+            # Изображения готовим параллельно, каждое в своем потоке
+            image_parts = await asyncio.gather(*(
+                self.image_content_part(image_data, img) for _, image_data, img in items
+            ))
+            content = [{"type": "text", "text": MULTI_IMAGE_ANALYSIS_PROMPT.format(image_count=len(items))}]
+            for number, image_part in enumerate(image_parts, 1):
+                content.append({"type": "text", "text": f"Изображение {number}"})
+                content.append(image_part)
             
-            return response.choices[0].message.content.strip()
+            text = await self.create_completion(
+                [{"role": "user", "content": content}], ANALYSIS_MAX_TOKENS * len(items)
+            )
+            return self.split_numbered_answers(text, len(items))
+        except Exception as e:
+            logger.error(f"Ошибка при совместном анализе {len(items)} изображений: {e}")
+            return {}
+
+    def split_numbered_answers(self, text: str, count: int) -> Dict[int, str]:
+        """Разбирает ответ совместного запроса на блоки по номерам изображений (с нуля)"""
+        parts = MULTI_IMAGE_HEADER_RE.split(text)
+        answers = {}
+        for number, answer in zip(parts[1::2], parts[2::2]):
+            index = int(number) - 1
+            # Блок без строк "а. ..." считаем пропущенным
+            if 0 <= index < count and ANALYSIS_LINE_RE.search(answer):
+                answers.setdefault(index, answer.strip())
+        return answers
+
+    async def request_analysis(self, image_data: bytes, filename: str, img: Optional[Image.Image] = None) -> str:
+        """Анализирует изображение с помощью OpenAI Vision API по заданным критериям"""
+        try:
+            messages = await self.build_analysis_messages(image_data, filename, img)
+            return await self.create_completion(messages)
             
         except Exception as e:
             logger.error(f"Ошибка при анализе изображения {filename}: {e}")
             return f"Ошибка при анализе изображения: {str(e)}"
 
-    def is_valid_image(self, data: bytes) -> bool:
-        """Проверяет, является ли файл валидным изображением"""
+    async def submit_batch(self, requests: List[Tuple[str, List[dict]]]) -> str:
+        """Отправляет запросы анализа в OpenAI Batch API и возвращает id задания"""
+        lines = [
+            json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": self.completion_params(messages)
+            }, ensure_ascii=False)
+            for custom_id, messages in requests
+        ]
+        
+        batch_file = await self.openai_client.files.create(
+            file=("batch.jsonl", "\n".join(lines).encode('utf-8')),
+            purpose="batch"
+        )
+        batch = await self.openai_client.batches.create(
+            input_file_id=batch_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window="24h"
+        )
+        return batch.id
+
+    async def get_batch_results(self, batch_id: str) -> Optional[Dict[str, str]]:
+        """Возвращает результаты пакетного задания по custom_id или None, пока задание выполняется"""
+        batch = await self.openai_client.batches.retrieve(batch_id)
+        if batch.status in ('failed', 'expired', 'cancelled'):
+            raise Exception(f"пакетное задание завершилось со статусом {batch.status}")
+        if batch.status != 'completed':
+            return None
+        
+        results = {}
+        if batch.output_file_id:
+            output = await self.openai_client.files.content(batch.output_file_id)
+            for line in output.text.splitlines():
+                if not line.strip():
+                    continue
+                item = json.loads(line)
+                response = item.get('response') or {}
+                if response.get('status_code') == 200:
+                    results[item['custom_id']] = response['body']['choices'][0]['message']['content'].strip()
+        
+        return results
+
+    def dedup_signature(self, image_data: bytes) -> Tuple[int, Image.Image]:
+        """Возвращает dHash и цветную уменьшенную копию изображения для поиска повторов"""
+        with Image.open(io.BytesIO(image_data)) as img:
+            # JPEG сразу декодируется в уменьшенном масштабе с запасом для точного сравнения
+            img.draft('RGB', (DEDUP_THUMB_SIZE * 8, DEDUP_THUMB_SIZE * 8))
+            ImageOps.exif_transpose(img, in_place=True)
+            rgb = self.flatten_to_rgb(img)
+            thumbnail = rgb.resize((DEDUP_THUMB_SIZE, DEDUP_THUMB_SIZE), Image.Resampling.BOX)
+            pixels = rgb.convert('L').resize((DHASH_SIZE + 1, DHASH_SIZE), Image.Resampling.BILINEAR).tobytes()
+        
+        # Каждый бит показывает, светлее ли соседний справа пиксель
+        dhash = 0
+        for row in range(0, len(pixels), DHASH_SIZE + 1):
+            for col in range(row, row + DHASH_SIZE):
+                dhash = (dhash << 1) | (pixels[col] < pixels[col + 1])
+        return dhash, thumbnail
+
+    def images_match(self, first: Image.Image, second: Image.Image) -> bool:
+        """Сравнивает уменьшенные копии попиксельно по всем каналам с небольшим допуском"""
+        difference = ImageChops.difference(first, second)
+        return max(high for _, high in difference.getextrema()) <= DEDUP_PIXEL_TOLERANCE
+
+    def dedup_keys(self, images: List[Tuple[str, bytes, Image.Image]]) -> List[bytes]:
+        """Возвращает ключи для поиска повторов в архиве: общий ключ только у совпадающих изображений"""
+        keys = []
+        candidates = []  # (dHash, уменьшенная копия, ключ) уже встреченных статичных изображений
+        for filename, image_data, _ in images:
+            key = hashlib.blake2b(image_data, digest_size=16).digest()
+            # У GIF с одинаковым первым кадром анимация может отличаться, поэтому для них только точный хэш
+            if not filename.lower().endswith('.gif'):
+                try:
+                    dhash, thumbnail = self.dedup_signature(image_data)
+                except Exception as e:
+                    logger.warning(f"Не удалось вычислить перцептивный хэш {filename}: {e}")
+                else:
+                    # Близкий dHash лишь кандидат: он не различает цвет и мелкий текст,
+                    # поэтому повтор подтверждается сравнением цветных уменьшенных копий
+                    for other_hash, other_thumbnail, other_key in candidates:
+                        if ((dhash ^ other_hash).bit_count() <= DHASH_MAX_DISTANCE
+                                and self.images_match(thumbnail, other_thumbnail)):
+                            key = other_key
+                            break
+                    else:
+                        candidates.append((dhash, thumbnail, key))
+            keys.append(key)
+        return keys
+
+    def open_image(self, data: bytes) -> Optional[Image.Image]:
+        """Открывает изображение для валидации, возвращает None для невалидных файлов"""
+        # Быстро отсеиваем файлы, которые не начинаются с сигнатуры JPEG/PNG/GIF
+        if not data.startswith(IMAGE_SIGNATURES):
+            return None
+        
         try:
-            with Image.open(io.BytesIO(data)) as img:
-                img.verify()
-            return True
+            # Читается только заголовок, пиксели декодируются один раз при анализе,
+            # где битые данные вызовут ошибку
+            return Image.open(io.BytesIO(data))
         except Exception:
-            return False
+            return None
 
-    def extract_gif_frames(self, gif_data: bytes) -> List[bytes]:
+    def extract_gif_frames(self, gif: Image.Image) -> List[bytes]:
         """Извлекает ключевые кадры из GIF анимации"""
         frames = []
         try:
-            with Image.open(io.BytesIO(gif_data)) as gif:
-                if not getattr(gif, 'is_animated', False):
-                    # Если это не анимированный GIF, обрабатываем как обычное изображение
-                    gif_copy = gif.copy()
-                    frame_buffer = io.BytesIO()
-                    gif_copy.save(frame_buffer, format='PNG')
-                    frames.append(frame_buffer.getvalue())
-                    return frames
-                
+            with gif:
+                # Неанимированный GIF дает ровно один кадр
                 frame_count = getattr(gif, 'n_frames', 1)
                 
                 # Выбираем кадры равномерно по всей анимации
                 step = max(1, frame_count // MAX_GIF_FRAMES)
-                selected_frames = list(range(0, frame_count, step))[:MAX_GIF_FRAMES]
+                selected_frames = set(range(0, frame_count, step)[:MAX_GIF_FRAMES])
+                last_selected = max(selected_frames)
                 
-                for frame_idx in selected_frames:
-                    gif.seek(frame_idx)
-                    # Конвертируем в RGB если нужно
-                    frame = gif.convert('RGB')
+                # Проходим кадры последовательно: seek назад заново декодирует GIF с начала
+                for frame_idx, gif_frame in enumerate(ImageSequence.Iterator(gif)):
+                    if frame_idx > last_selected:
+                        break
+                    if frame_idx not in selected_frames:
+                        continue
+                    
+                    # Работаем с копией кадра, чтобы thumbnail не изменил сам GIF
+                    frame = self.flatten_to_rgb(gif_frame.copy())
+                    frame.thumbnail((MAX_IMAGE_SIDE, MAX_IMAGE_SIDE), Image.Resampling.BILINEAR)
                     
-                    # Сохраняем кадр в PNG формате
+                    # Сохраняем кадр в JPEG: кодируется быстрее PNG и занимает меньше места
                     frame_buffer = io.BytesIO()
-                    frame.save(frame_buffer, format='PNG')
+                    frame.save(frame_buffer, format='JPEG', quality=JPEG_QUALITY)
                     frames.append(frame_buffer.getvalue())
                     
         except Exception as e:
@@ -135,101 +717,6 @@ class ImageAnalyzer:
             
         return frames
 
-    async def analyze_gif_frames(self, frames: List[bytes], filename: str) -> str:
-        """Анализирует кадры GIF с игнорированием дисклеймеров"""
-        if not frames:
-            return "Ошибка: не удалось извлечь кадры из GIF"
-        
-        try:
-            # Анализируем каждый кадр
-            frame_analyses = []
-            
-            for i, frame_data in enumerate(frames):
-                base64_image = base64.b64encode(frame_data).decode('utf-8')
-                
-                response = await self.openai_client.chat.completions.create(
-                    model="gpt-4o-mini",
-                    messages=[
-                        {
-                            "role": "user",
-                            "content": [
-                                {
-                                    "type": "text",
-                                    "text": f"""Проанализируйте кадр {i+1} из GIF анимации по следующим критериям. ВАЖНО: игнорируйте любые дисклеймеры, юридические уведомления, мелкий текст с правовой информацией, предупреждения о рисках.
-
-а. Есть ли на картинке реалистичное фото? (да/нет)
-б. Есть ли на картинке иллюстрация? (да/нет) 
-в. Что изображено на картинке крупнее всего: люди или какие именно предметы?
-г. Каков основной цвет фона?
-д. Содержится ли на картинке сообщение о скидке или выгоде? (да/нет, игнорируйте юридические дисклеймеры)
-
-Ответьте строго по формату:
-а. [ответ]
-б. [ответ]
-в. [ответ]
-г. [ответ]
-д. [ответ]"""
-                                },
-                                {
-                                    "type": "image_url",
-                                    "image_url": {
-                                        "url": f"data:image/png;base64,{base64_image}"
-                                    }
-                                }
-                            ]
-                        }
-                    ],
-                    max_tokens=200
-                )
-                
-                frame_analysis = response.choices[0].message.content.strip()
-                frame_analyses.append(f"Кадр {i+1}:\n{frame_analysis}")
-                
-                # Небольшая задержка между запросами
-                await asyncio.sleep(0.3)
-            
-            # Объединяем анализ всех кадров и делаем общий вывод
-            combined_analysis = await self.combine_frame_analyses(frame_analyses, filename)
-            return combined_analysis
-            
-        except Exception as e:
-            logger.error(f"Ошибка при анализе GIF {filename}: {e}")
-            return f"Ошибка при анализе GIF: {str(e)}"
-
-    async def combine_frame_analyses(self, frame_analyses: List[str], filename: str) -> str:
-        """Объединяет анализ кадров в общий результат"""
-        try:
-            combined_text = "\n\n".join(frame_analyses)
-            
-            response = await self.openai_client.chat.completions.create(
-                model="gpt-4o-mini",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": f"""На основе анализа {len(frame_analyses)} кадров GIF анимации, дайте ОБЩИЙ итоговый анализ по тем же критериям. Учитывайте доминирующие характеристики по всем кадрам:
-
-{combined_text}
-
-Дайте итоговый ответ по формату:
-а. [общий ответ по всем кадрам]
-б. [общий ответ по всем кадрам]
-в. [что доминирует по всем кадрам]
-г. [преобладающий цвет фона]
-д. [есть ли промо-контент, игнорируя дисклеймеры]"""
-                    }
-                ],
-                max_tokens=150
-            )
-            
-            return response.choices[0].message.content.strip()
-            
-        except Exception as e:
-            logger.error(f"Ошибка при объединении анализа кадров для {filename}: {e}")
-            # Возвращаем анализ первого кадра как fallback
-            if frame_analyses:
-                return frame_analyses[0]
-            return "Ошибка при объединении анализа кадров"
-
     def parse_analysis_results(self, analysis_text: str) -> dict:
         """Парсит результаты анализа в структурированный формат"""
         results = {
@@ -240,45 +727,37 @@ class ImageAnalyzer:
             'discount_message': 'unknown'
         }
         
-        lines = analysis_text.split('\n')
-        for line in lines:
-            line = line.strip()
-            if line.startswith('а.'):
-                results['realistic_photo'] = 'yes' if 'да' in line.lower() else 'no'
-            elif line.startswith('б.'):
-                results['illustration'] = 'yes' if 'да' in line.lower() else 'no'
-            elif line.startswith('в.'):
-                # Извлекаем основной объект после "в."
-                obj_text = line[2:].strip().lower()
-                if 'люди' in obj_text or 'человек' in obj_text:
-                    results['main_object'] = 'people'
-                elif any(word in obj_text for word in ['телефон', 'компьютер', 'машина', 'автомобиль']):
-                    results['main_object'] = 'tech'
-                elif any(word in obj_text for word in ['еда', 'продукт', 'товар', 'одежда']):
-                    results['main_object'] = 'product'
+        for letter, value in ANALYSIS_LINE_RE.findall(analysis_text):
+            value = value.strip().lower()
+            if letter in YES_NO_FIELDS:
+                # Ответ да/нет стоит первым словом, поиск по всей строке путает его с «удалось», «надпись»
+                results[YES_NO_FIELDS[letter]] = 'yes' if value.lstrip('[*').startswith('да') else 'no'
+            elif letter == 'в':
+                # Определяем категорию основного объекта по ключевым словам
+                for keywords, category in OBJECT_KEYWORDS:
+                    if any(word in value for word in keywords):
+                        results['main_object'] = category
+                        break
                 else:
                     # Берем первое слово как основной объект
-                    words = obj_text.split()
+                    words = value.split()
                     if words:
                         results['main_object'] = words[0][:10]  # Ограничиваем длину
-            elif line.startswith('г.'):
-                color_text = line[2:].strip().lower()
-                colors_map = {
-                    'белый': 'white', 'черный': 'black', 'красный': 'red',
-                    'синий': 'blue', 'зеленый': 'green', 'желтый': 'yellow',
-                    'серый': 'gray', 'коричневый': 'brown', 'розовый': 'pink'
-                }
-                for ru_color, en_color in colors_map.items():
-                    if ru_color in color_text:
-                        results['background_color'] = en_color
-                        break
-                else:
-                    # Если не нашли стандартный цвет, берем первое слово
-                    words = color_text.split()
-                    if words:
-                        results['background_color'] = words[0][:8]
-            elif line.startswith('д.'):
-                results['discount_message'] = 'yes' if 'да' in line.lower() else 'no'
+            elif letter == 'г':
+                words = value.split()
+                # Обычно модель отвечает одним словом, поэтому сначала пробуем точное совпадение
+                color = COLORS_MAP.get(words[0]) if words else None
+                if color is None:
+                    for ru_color, en_color in COLORS_MAP.items():
+                        if ru_color in value:
+                            color = en_color
+                            break
+                    else:
+                        # Если не нашли стандартный цвет, берем первое слово
+                        if words:
+                            color = words[0][:8]
+                if color is not None:
+                    results['background_color'] = color
         
         return results
 
@@ -296,7 +775,7 @@ class ImageAnalyzer:
         sale = '1' if analysis_results['discount_message'] == 'yes' else '0'
         
         # Очищаем имя от специальных символов
-        clean_name = "".join(c for c in name if c.isalnum() or c in ('-', '_'))[:20]
+        clean_name = FILENAME_DISALLOWED_RE.sub('', name)[:20]
         
         # Добавляем префикс для GIF файлов
         gif_prefix = "GIF-" if ext.lower() == '.gif' else ""
@@ -305,9 +784,56 @@ class ImageAnalyzer:
         
         return new_name
 
+class StatusUpdater:
+    """Обновляет статусное сообщение в фоне не чаще раза в интервал, промежуточные тексты пропускаются"""
+
+    def __init__(self, message: Message, min_interval: float = STATUS_UPDATE_INTERVAL):
+        self.message = message
+        self.min_interval = min_interval
+        self.text = message.text  # Последний запрошенный текст
+        self.shown_text = message.text  # Текст, который сейчас виден в чате
+        self.changed = asyncio.Event()
+        self.task = asyncio.create_task(self.run())
+
+    def update(self, text: str):
+        """Запоминает новый текст статуса, сообщение обновится в фоне"""
+        self.text = text
+        self.changed.set()
+
+    async def run(self):
+        """Фоновая задача: показывает последний текст и выдерживает паузу перед следующим"""
+        while True:
+            await self.changed.wait()
+            self.changed.clear()
+            await self.show(self.text)
+            await asyncio.sleep(self.min_interval)
+
+    async def show(self, text: str):
+        """Редактирует сообщение, если текст изменился"""
+        if text == self.shown_text:
+            return
+        try:
+            await self.message.edit_text(text)
+            self.shown_text = text
+        except TelegramError as e:
+            # Неудачное обновление статуса не должно прерывать обработку архива
+            logger.warning(f"Не удалось обновить статусное сообщение: {e}")
+
+    async def finish(self, text: Optional[str] = None):
+        """Останавливает фоновые обновления и сразу показывает итоговый текст"""
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
+        if text is not None:
+            await self.show(text)
+
 class TelegramBot:
     def __init__(self):
         self.analyzer = ImageAnalyzer()
+        # Фоновые задачи ожидания пакетных заданий (ссылки нужны, чтобы задачи не собрал GC)
+        self.batch_tasks = set()
 
     async def start_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обработчик команды /start"""
@@ -343,6 +869,9 @@ class TelegramBot:
 • Игнорирование юридических дисклеймеров
 • Общий анализ по всей анимации
 
+🕓 *Пакетный режим:*
+Отправьте /batch перед архивом — анализ через OpenAI Batch API обойдется примерно вдвое дешевле, а результаты придут позже (до 24 часов)
+
 ⚠️ *Ограничения:*
 • Максимальный размер файла: 20MB
 • Поддерживаемые форматы: JPG, JPEG, PNG, GIF
@@ -356,48 +885,86 @@ class TelegramBot:
             parse_mode=ParseMode.MARKDOWN
         )
 
-    async def extract_images_from_zip(self, zip_data: bytes) -> List[Tuple[str, bytes]]:
-        """Извлекает изображения из ZIP архива"""
+    async def batch_command(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """Обработчик команды /batch: следующий архив будет обработан через Batch API"""
+        context.user_data['batch_mode'] = True
+        await update.message.reply_text(
+            "🕓 *Пакетный режим включен*\n\n"
+            "Следующий ZIP архив будет проанализирован через OpenAI Batch API: "
+            "это примерно вдвое дешевле, но результаты придут позже (до 24 часов).",
+            parse_mode=ParseMode.MARKDOWN
+        )
+
+    async def extract_images_from_zip(self, zip_stream: BinaryIO) -> List[Tuple[str, bytes, Image.Image]]:
+        """Извлекает изображения из ZIP архива в отдельном потоке"""
+        try:
+            # Распаковка и проверка файлов блокирующие, поэтому не выполняем их в event loop
+            return await asyncio.to_thread(self.read_images_from_zip, zip_stream)
+        except Exception as e:
+            logger.error(f"Ошибка при извлечении ZIP архива: {e}")
+            raise Exception(f"Ошибка при обработке ZIP архива: {str(e)}")
+
+    def read_images_from_zip(self, zip_stream: BinaryIO) -> List[Tuple[str, bytes, Image.Image]]:
+        """Читает и проверяет изображения из ZIP архива"""
         images = []
         
-        try:
-            with zipfile.ZipFile(io.BytesIO(zip_data), 'r') as zip_file:
-                for file_info in zip_file.filelist:
-                    # Пропускаем директории
-                    if file_info.is_dir():
-                        continue
-                    
-                    filename = file_info.filename
-                    file_ext = os.path.splitext(filename.lower())[1]
+        # zipfile читает центральный каталог и распаковывает только нужные файлы
+        with zipfile.ZipFile(zip_stream, 'r') as zip_file:
+            # Сортируем по имени, чтобы лимит в 10 изображений всегда выбирал одни и те же файлы
+            for file_info in sorted(zip_file.filelist, key=lambda info: info.filename):
+                # Пропускаем директории
+                if file_info.is_dir():
+                    continue
+                
+                filename = file_info.filename
+                
+                # Пропускаем служебные файлы macOS (__MACOSX/, ._*) и скрытые файлы
+                if filename.startswith('__MACOSX/') or os.path.basename(filename).startswith('.'):
+                    continue
+                
+                file_ext = os.path.splitext(filename.lower())[1]
+                
+                # Проверяем формат файла
+                if file_ext not in SUPPORTED_FORMATS:
+                    continue
+                
+                # Размер из центрального каталога позволяет отсеять большие файлы без распаковки
+                if file_info.file_size > MAX_IMAGE_SIZE:
+                    logger.warning(f"Файл {filename} слишком большой после распаковки, пропускаем")
+                    continue
+                
+                # Извлекаем данные файла
+                try:
+                    with zip_file.open(file_info) as entry:
+                        # Сначала читаем только заголовок, чтобы не распаковывать посторонние файлы
+                        header = entry.read(IMAGE_HEADER_SIZE)
+                        if not header.startswith(IMAGE_SIGNATURES):
+                            continue
+                        # Ограничиваем чтение, чтобы сильно сжатый файл не раздул память
+                        file_data = header + entry.read(MAX_IMAGE_SIZE - len(header) + 1)
                     
-                    # Проверяем формат файла
-                    if file_ext not in SUPPORTED_FORMATS:
+                    if len(file_data) > MAX_IMAGE_SIZE:
+                        logger.warning(f"Файл {filename} слишком большой после распаковки, пропускаем")
                         continue
                     
-                    # Извлекаем данные файла
-                    try:
-                        file_data = zip_file.read(file_info)
+                    # Проверяем, что это валидное изображение, и сохраняем открытый файл
+                    img = self.analyzer.open_image(file_data)
+                    if img is not None:
+                        images.append((filename, file_data, img))
                         
-                        # Проверяем, что это валидное изображение
-                        if self.analyzer.is_valid_image(file_data):
-                            images.append((filename, file_data))
+                        # Ограничиваем количество изображений
+                        if len(images) >= 10:
+                            break
                             
-                            # Ограничиваем количество изображений
-                            if len(images) >= 10:
-                                break
-                                
-                    except Exception as e:
-                        logger.warning(f"Не удалось извлечь файл {filename}: {e}")
-                        continue
-                        
-        except Exception as e:
-            logger.error(f"Ошибка при извлечении ZIP архива: {e}")
-            raise Exception(f"Ошибка при обработке ZIP архива: {str(e)}")
+                except Exception as e:
+                    logger.warning(f"Не удалось извлечь файл {filename}: {e}")
+                    continue
         
         return images
 
     async def process_zip_file(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Обрабатывает ZIP файл с изображениями"""
+        status = None
         try:
             # Проверяем тип файла
             if not update.message.document:
@@ -406,11 +973,6 @@ class TelegramBot:
             
             document = update.message.document
             
-            # Проверяем расширение файла
-            if not document.file_name.lower().endswith('.zip'):
-                await update.message.reply_text("❌ Пожалуйста, отправьте файл с расширением .zip")
-                return
-            
             # Проверяем размер файла
             if document.file_size > MAX_FILE_SIZE:
                 await update.message.reply_text(f"❌ Файл слишком большой. Максимальный размер: {MAX_FILE_SIZE // (1024*1024)}MB")
@@ -418,166 +980,271 @@ class TelegramBot:
             
             # Отправляем сообщение о начале обработки
             processing_message = await update.message.reply_text("🔄 Обрабатываю ZIP архив...")
+            status = StatusUpdater(processing_message)
             
-            # Скачиваем файл
+            # Скачиваем файл сразу в буфер без промежуточных копий:
+            # небольшие архивы остаются в памяти, крупные сбрасываются на диск
             file = await context.bot.get_file(document.file_id)
-            zip_data = await file.download_as_bytearray()
-            
-            # Извлекаем изображения
-            await processing_message.edit_text("📂 Извлекаю изображения из архива...")
-            images = await self.extract_images_from_zip(bytes(zip_data))
+            with tempfile.SpooledTemporaryFile(max_size=ZIP_SPOOL_MAX_SIZE) as zip_stream:
+                await file.download_to_memory(out=zip_stream)
+                zip_stream.seek(0)
+                
+                # Извлекаем изображения
+                status.update("📂 Извлекаю изображения из архива...")
+                images = await self.extract_images_from_zip(zip_stream)
             
             if not images:
-                await processing_message.edit_text("❌ В архиве не найдено валидных изображений (JPG/PNG).")
+                await status.finish("❌ В архиве не найдено валидных изображений (JPG/PNG).")
                 return
             
-            await processing_message.edit_text(f"🖼️ Найдено {len(images)} изображений. Анализирую содержимое...")
-            
-            # Анализируем изображения
-            results = []
-            images_with_analysis = []  # Для создания переименованного архива
-            
-            for i, (filename, image_data) in enumerate(images, 1):
-                if filename.lower().endswith('.gif'):
-                    await processing_message.edit_text(f"🎞️ Анализирую GIF анимацию {i}/{len(images)}: {filename}\n(анализ кадров может занять больше времени)")
-                else:
-                    await processing_message.edit_text(f"🔍 Анализирую изображение {i}/{len(images)}: {filename}")
-                
-                description = await self.analyzer.analyze_image(image_data, filename)
-                results.append((filename, description))
-                images_with_analysis.append((filename, image_data, description))
-                
-                # Небольшая задержка для избежания rate limit
-                await asyncio.sleep(0.5)
+            # В пакетном режиме отправляем задание в Batch API, результаты придут позже
+            if context.user_data.pop('batch_mode', False):
+                await self.submit_batch_analysis(update, context, images, document.file_name, status)
+                return
             
-            # Создаем переименованный ZIP архив
-            await processing_message.edit_text("📦 Создаю переименованный архив...")
-            renamed_zip_data = await self.create_renamed_zip(images_with_analysis)
+            # Одинаковые и почти одинаковые изображения анализируем один раз
+            image_hashes = await asyncio.to_thread(self.analyzer.dedup_keys, images)
+            unique_images = {}  # хэш -> первый файл с таким содержимым
+            for (filename, image_data, img), image_hash in zip(images, image_hashes):
+                unique_images.setdefault(image_hash, (filename, image_data, img))
             
-            # Форматируем результаты в таблицу
-            await processing_message.edit_text("📊 Формирую результаты...")
-            table = self.format_results_table(results)
+            if len(unique_images) < len(images):
+                status.update(
+                    f"🖼️ Найдено {len(images)} изображений (уникальных: {len(unique_images)}). Анализирую содержимое..."
+                )
+            else:
+                status.update(f"🖼️ Найдено {len(images)} изображений. Анализирую содержимое...")
             
-            # Отправляем результаты
-            await processing_message.delete()
+            # Статичные изображения анализируем группами по IMAGES_PER_REQUEST в одном запросе,
+            # группы обрабатываются параллельно (лимит запросов соблюдает ImageAnalyzer)
+            async def analyze_group(group: List[Tuple[bytes, Tuple[str, bytes, Image.Image]]]) -> List[Tuple[bytes, str]]:
+                descriptions = await self.analyzer.analyze_images_batch([item for _, item in group])
+                return [(image_hash, description) for (image_hash, _), description in zip(group, descriptions)]
             
-            # Разбиваем длинное сообщение на части если нужно
-            if len(table) > 4096:
-                parts = self.split_message(table, 4096)
-                for i, part in enumerate(parts):
-                    await update.message.reply_text(part, parse_mode=ParseMode.MARKDOWN)
-            else:
-                await update.message.reply_text(table, parse_mode=ParseMode.MARKDOWN)
+            unique_items = list(unique_images.items())
+            group_size = max(1, IMAGES_PER_REQUEST)
+            tasks = [
+                analyze_group(unique_items[i:i + group_size])
+                for i in range(0, len(unique_items), group_size)
+            ]
+            analyses = {}  # хэш -> (текст анализа, структурированный результат)
             
-            # Отправляем переименованный ZIP архив
-            await update.message.reply_text(
-                "📤 *Переименованный архив готов к скачиванию!*\n\n"
-                "📁 Файлы переименованы согласно результатам анализа\n"
-                "📋 В архиве есть README с расшифровкой схемы именования",
-                parse_mode=ParseMode.MARKDOWN
-            )
+            for task in asyncio.as_completed(tasks):
+                for image_hash, description in await task:
+                    # Парсим каждый ответ один раз, результат используется при переименовании
+                    analyses[image_hash] = (description, self.analyzer.parse_analysis_results(description))
+                status.update(f"🔍 Проанализировано изображений: {len(analyses)}/{len(unique_items)}")
             
-            # Создаем имя для нового архива
-            original_name = document.file_name.replace('.zip', '')
-            new_archive_name = f"{original_name}_analyzed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+            images_with_analysis = [
+                (filename, image_data, *analyses[image_hash])
+                for (filename, image_data, _), image_hash in zip(images, image_hashes)
+            ]
             
-            # Отправляем архив
-            await context.bot.send_document(
-                chat_id=update.effective_chat.id,
-                document=io.BytesIO(renamed_zip_data),
-                filename=new_archive_name,
-                caption="📂 Переименованные изображения с анализом"
-            )
+            # Создаем переименованный архив и отправляем результаты
+            status.update("📦 Создаю переименованный архив...")
+            await self.send_results(context.bot, update.effective_chat.id, images_with_analysis, document.file_name)
+            await status.finish()
+            await processing_message.delete()
                 
         except Exception as e:
             logger.error(f"Ошибка при обработке ZIP файла: {e}")
+            if status is not None:
+                await status.finish()
             await update.message.reply_text(f"❌ Произошла ошибка при обработке файла: {str(e)}")
 
+    async def submit_batch_analysis(self, update: Update, context: ContextTypes.DEFAULT_TYPE,
+                                    images: List[Tuple[str, bytes, Image.Image]], archive_name: str, status: StatusUpdater):
+        """Отправляет анализ архива в OpenAI Batch API и запускает ожидание результатов"""
+        status.update(f"📨 Готовлю пакетное задание для {len(images)} изображений...")
+        
+        requests = []
+        for i, (filename, image_data, img) in enumerate(images):
+            try:
+                messages = await self.analyzer.build_analysis_messages(image_data, filename, img)
+            except Exception as e:
+                logger.error(f"Ошибка при подготовке изображения {filename} для пакетного анализа: {e}")
+                continue
+            requests.append((str(i), messages))
+        
+        if not requests:
+            await status.finish("❌ Не удалось подготовить изображения для пакетного анализа.")
+            return
+        
+        batch_id = await self.analyzer.submit_batch(requests)
+        logger.info(f"Создано пакетное задание {batch_id} для чата {update.effective_chat.id}")
+        
+        await status.finish(
+            f"✅ Пакетное задание создано для {len(requests)} изображений.\n"
+            "Результаты и переименованный архив придут в этот чат, как только OpenAI их подготовит (до 24 часов)."
+        )
+        
+        # Данные изображений храним в памяти до получения результатов
+        pending_images = [(filename, image_data) for filename, image_data, _ in images]
+        task = asyncio.create_task(
+            self.wait_for_batch(context.bot, update.effective_chat.id, batch_id, pending_images, archive_name)
+        )
+        self.batch_tasks.add(task)
+        task.add_done_callback(self.batch_tasks.discard)
+
+    async def wait_for_batch(self, bot: Bot, chat_id: int, batch_id: str,
+                             images: List[Tuple[str, bytes]], archive_name: str):
+        """Опрашивает пакетное задание и отправляет результаты в чат по готовности"""
+        try:
+            while True:
+                await asyncio.sleep(BATCH_POLL_INTERVAL)
+                try:
+                    batch_results = await self.analyzer.get_batch_results(batch_id)
+                except APIError as e:
+                    # Временные ошибки API не прерывают ожидание
+                    logger.warning(f"Не удалось получить статус пакетного задания {batch_id}: {e}")
+                    continue
+                if batch_results is not None:
+                    break
+            
+            images_with_analysis = []
+            for i, (filename, image_data) in enumerate(images):
+                description = batch_results.get(str(i), "Ошибка: изображение не обработано в пакетном режиме")
+                images_with_analysis.append(
+                    (filename, image_data, description, self.analyzer.parse_analysis_results(description))
+                )
+            await self.send_results(bot, chat_id, images_with_analysis, archive_name)
+            
+        except Exception as e:
+            logger.error(f"Ошибка при обработке пакетного задания {batch_id}: {e}")
+            await bot.send_message(chat_id=chat_id, text=f"❌ Не удалось получить результаты пакетного анализа: {str(e)}")
+
+    async def send_results(self, bot: Bot, chat_id: int, images_with_analysis: List[Tuple[str, bytes, str, dict]], archive_name: str):
+        """Отправляет таблицу результатов и переименованный ZIP архив в чат"""
+        renamed_zip_data = await self.create_renamed_zip(images_with_analysis)
+        
+        # Форматируем результаты в таблицу
+        results = [(filename, description) for filename, _, description, _ in images_with_analysis]
+        table = self.format_results_table(results)
+        
+        # Разбиваем длинное сообщение на части если нужно
+        if len(table) > 4096:
+            parts = self.split_message(table, 4096)
+            for part in parts:
+                await bot.send_message(chat_id=chat_id, text=part, parse_mode=ParseMode.MARKDOWN)
+        else:
+            await bot.send_message(chat_id=chat_id, text=table, parse_mode=ParseMode.MARKDOWN)
+        
+        # Отправляем переименованный ZIP архив
+        await bot.send_message(
+            chat_id=chat_id,
+            text="📤 *Переименованный архив готов к скачиванию!*\n\n"
+                 "📁 Файлы переименованы согласно результатам анализа\n"
+                 "📋 В архиве есть README с расшифровкой схемы именования",
+            parse_mode=ParseMode.MARKDOWN
+        )
+        
+        # Создаем имя для нового архива
+        original_name = archive_name.replace('.zip', '')
+        new_archive_name = f"{original_name}_analyzed_{datetime.now().strftime('%Y%m%d_%H%M%S')}.zip"
+        
+        await bot.send_document(
+            chat_id=chat_id,
+            document=io.BytesIO(renamed_zip_data),
+            filename=new_archive_name,
+            caption="📂 Переименованные изображения с анализом"
+        )
+
     def format_results_table(self, results: List[Tuple[str, str]]) -> str:
         """Форматирует результаты в виде таблицы"""
         if not results:
             return "❌ Нет результатов для отображения."
         
-        table = "📊 *Результаты анализа изображений*\n\n"
-        table += f"🕒 Время обработки: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n"
-        table += f"📁 Обработано файлов: {len(results)}\n\n"
+        # Собираем части в список и склеиваем один раз в конце
+        parts = [
+            "📊 *Результаты анализа изображений*\n\n",
+            f"🕒 Время обработки: {datetime.now().strftime('%d.%m.%Y %H:%M:%S')}\n",
+            f"📁 Обработано файлов: {len(results)}\n\n"
+        ]
         
         for i, (filename, description) in enumerate(results, 1):
-            table += f"*{i}\\. {self.escape_markdown(filename)}*\n"
+            parts.append(f"*{i}\\. {self.escape_markdown(filename)}*\n")
             
-            # Форматируем структурированный анализ
-            lines = description.split('\n')
-            formatted_analysis = ""
-            for line in lines:
+            # Форматируем структурированный анализ, экранируя весь блок за один проход
+            analysis_lines = []
+            for line in description.split('\n'):
                 line = line.strip()
                 if line and not line.startswith('Ошибка'):
-                    if line.startswith(('а.', 'б.', 'в.', 'г.', 'д.')):
-                        formatted_analysis += f"  {self.escape_markdown(line)}\n"
+                    if ANALYSIS_ITEM_PREFIX_RE.match(line):
+                        analysis_lines.append(f"  {line}\n")
                     else:
-                        formatted_analysis += f"{self.escape_markdown(line)}\n"
+                        analysis_lines.append(f"{line}\n")
             
-            if formatted_analysis.strip():
-                table += f"📋 *Анализ:*\n{formatted_analysis}\n"
+            if analysis_lines:
+                parts.append(f"📋 *Анализ:*\n{self.escape_markdown(''.join(analysis_lines))}\n")
             else:
-                table += f"📝 {self.escape_markdown(description)}\n\n"
+                parts.append(f"📝 {self.escape_markdown(description)}\n\n")
             
-            table += "─" * 40 + "\n\n"
+            parts.append(RESULTS_SEPARATOR)
         
-        return table
+        return "".join(parts)
 
     def escape_markdown(self, text: str) -> str:
         """Экранирует специальные символы для Markdown"""
-        special_chars = ['_', '*', '[', ']', '(', ')', '~', '`', '>', '#', '+', '-', '=', '|', '{', '}', '.', '!']
-        for char in special_chars:
-            text = text.replace(char, f'\\{char}')
-        return text
+        return text.translate(MARKDOWN_ESCAPE_TABLE)
 
     def split_message(self, text: str, max_length: int) -> List[str]:
         """Разбивает длинное сообщение на части"""
         parts = []
-        current_part = ""
-        
-        lines = text.split('\n')
-        for line in lines:
-            if len(current_part + line + '\n') > max_length:
-                if current_part:
-                    parts.append(current_part.strip())
-                    current_part = line + '\n'
-                else:
-                    # Если одна строка слишком длинная, разбиваем её
-                    while len(line) > max_length:
-                        parts.append(line[:max_length])
-                        line = line[max_length:]
-                    current_part = line + '\n'
-            else:
-                current_part += line + '\n'
+        # Копим строки в списке и считаем длину, чтобы не пересобирать строку на каждой итерации
+        buffer = []
+        buffer_length = 0
+        
+        for line in text.split('\n'):
+            if len(line) > max_length:
+                # Если одна строка слишком длинная, разбиваем её
+                if buffer:
+                    parts.append("".join(buffer).strip())
+                    buffer = []
+                    buffer_length = 0
+                chunks = [line[i:i + max_length] for i in range(0, len(line), max_length)]
+                parts.extend(chunks[:-1])
+                line = chunks[-1]
+            elif buffer_length + len(line) + 1 > max_length and buffer:
+                parts.append("".join(buffer).strip())
+                buffer = []
+                buffer_length = 0
+            
+            buffer.append(line + '\n')
+            buffer_length += len(line) + 1
         
-        if current_part:
-            parts.append(current_part.strip())
+        if buffer:
+            parts.append("".join(buffer).strip())
         
         return parts
 
-    async def create_renamed_zip(self, images_with_analysis: List[Tuple[str, bytes, str]]) -> bytes:
-        """Создает ZIP архив с переименованными файлами"""
+    async def create_renamed_zip(self, images_with_analysis: List[Tuple[str, bytes, str, dict]]) -> bytes:
+        """Создает ZIP архив с переименованными файлами в отдельном потоке"""
+        return await asyncio.to_thread(self.build_renamed_zip, images_with_analysis)
+
+    def build_renamed_zip(self, images_with_analysis: List[Tuple[str, bytes, str, dict]]) -> bytes:
+        """Собирает ZIP архив с переименованными файлами"""
         zip_buffer = io.BytesIO()
         
-        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        # Изображения уже сжаты, поэтому кладем их без повторного сжатия (ZIP_STORED)
+        with zipfile.ZipFile(zip_buffer, 'w', zipfile.ZIP_STORED) as zip_file:
             used_names = set()  # Для избежания дублирования имен
+            name_counters = {}  # Следующий номер суффикса для каждого базового имени
             
-            for i, (original_filename, image_data, analysis_text) in enumerate(images_with_analysis):
-                # Парсим результаты анализа
-                analysis_results = self.analyzer.parse_analysis_results(analysis_text)
-                
+            for original_filename, image_data, _, analysis_results in images_with_analysis:
                 # Создаем новое имя файла
-                new_filename = self.analyzer.create_new_filename(original_filename, analysis_results)
+                base_filename = self.analyzer.create_new_filename(original_filename, analysis_results)
+                new_filename = base_filename
                 
-                # Проверяем на дублирование и добавляем номер если нужно
-                original_new_filename = new_filename
-                counter = 1
-                while new_filename in used_names:
-                    name, ext = os.path.splitext(original_new_filename)
+                # При дублировании добавляем номер, продолжая с последнего выданного для этого имени
+                if new_filename in used_names:
+                    name, ext = os.path.splitext(base_filename)
+                    counter = name_counters.get(base_filename, 1)
                     new_filename = f"{name}_{counter:03d}{ext}"
-                    counter += 1
+                    # Суффиксное имя может совпасть с уже выданным обычным именем
+                    while new_filename in used_names:
+                        counter += 1
+                        new_filename = f"{name}_{counter:03d}{ext}"
+                    name_counters[base_filename] = counter + 1
                 
                 used_names.add(new_filename)
                 
@@ -609,7 +1276,7 @@ S[0/1] - Скидка/выгода (1=да, 0=нет)
 
 Создано ботом анализа изображений
 """
-            zip_file.writestr("README_naming_scheme.txt", readme_content)
+            zip_file.writestr("README_naming_scheme.txt", readme_content, compress_type=zipfile.ZIP_DEFLATED)
         
         zip_buffer.seek(0)
         return zip_buffer.getvalue()
@@ -628,14 +1295,23 @@ def main():
         logger.error("OPENAI_API_KEY не найден в переменных окружения")
         return
     
+    # uvloop быстрее стандартного event loop при большом числе параллельных задач
+    if uvloop is not None:
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    
     # Создаем экземпляр бота
     bot = TelegramBot()
     
+    # Закрываем соединения с OpenAI при остановке бота
+    async def close_openai_client(application: Application):
+        await openai_client.close()
+    
     # Создаем приложение
-    application = Application.builder().token(telegram_token).build()
+    application = Application.builder().token(telegram_token).post_shutdown(close_openai_client).build()
     
     # Добавляем обработчики
     application.add_handler(CommandHandler("start", bot.start_command))
+    application.add_handler(CommandHandler("batch", bot.batch_command))
     application.add_handler(MessageHandler(filters.Document.ZIP, bot.process_zip_file))
     
     # Обработчик для всех остальных сообщений
@@ -644,7 +1320,8 @@ def main():
             "❌ Пожалуйста, отправьте ZIP архив с изображениями или используйте команду /start для получения инструкций."
         )
     
-    application.add_handler(MessageHandler(filters.ALL & ~filters.Document.ZIP, handle_other_messages))
+    # В группе срабатывает первый подходящий обработчик, поэтому ZIP сюда уже не попадет
+    application.add_handler(MessageHandler(filters.ALL, handle_other_messages))
     
     # Запускаем бота
     logger.info("Запускаем бота...")
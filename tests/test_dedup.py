@@ -0,0 +1,70 @@
+import io
+import os
+import unittest
+
+os.environ.setdefault('OPENAI_API_KEY', 'sk-test')
+
+from PIL import Image, ImageDraw, ImageFont
+
+from main import ImageAnalyzer
+
+
+def encode(img: Image.Image, image_format: str, **params) -> bytes:
+    buffer = io.BytesIO()
+    img.save(buffer, format=image_format, **params)
+    return buffer.getvalue()
+
+
+def banner(text: str) -> Image.Image:
+    img = Image.new('RGB', (1200, 400), (240, 240, 240))
+    draw = ImageDraw.Draw(img)
+    draw.rectangle((50, 50, 400, 350), fill=(30, 90, 200))
+    draw.text((500, 150), text, fill='black', font=ImageFont.load_default(size=60))
+    return img
+
+
+def picture() -> Image.Image:
+    img = Image.new('RGB', (1200, 800), 'white')
+    draw = ImageDraw.Draw(img)
+    for i in range(20):
+        draw.ellipse((i * 50, i * 30, i * 50 + 200, i * 30 + 150), fill=(i * 12, 100, 255 - i * 12))
+    return img
+
+
+class DedupKeysTest(unittest.TestCase):
+    def setUp(self):
+        self.analyzer = ImageAnalyzer()
+
+    def keys(self, *items):
+        return self.analyzer.dedup_keys([(filename, data, None) for filename, data in items])
+
+    def test_color_variants_are_not_merged(self):
+        blue = encode(Image.new('RGB', (400, 300), 'blue'), 'JPEG')
+        red = encode(Image.new('RGB', (400, 300), 'red'), 'PNG')
+        first, second = self.keys(('a.jpg', blue), ('b.png', red))
+        self.assertNotEqual(first, second)
+
+    def test_text_variants_are_not_merged(self):
+        first, second = self.keys(
+            ('a.jpg', encode(banner('Buy now'), 'JPEG')),
+            ('b.jpg', encode(banner('SALE -50%'), 'JPEG'))
+        )
+        self.assertNotEqual(first, second)
+
+    def test_reencoded_copies_are_merged(self):
+        img = picture()
+        keys = self.keys(
+            ('a.jpg', encode(img, 'JPEG', quality=90)),
+            ('b.png', encode(img, 'PNG')),
+            ('c.jpg', encode(img.resize((600, 400)), 'JPEG', quality=60))
+        )
+        self.assertEqual(len(set(keys)), 1)
+
+    def test_gif_uses_exact_hash(self):
+        img = picture().convert('P')
+        first, second = self.keys(('a.gif', encode(img, 'GIF')), ('b.gif', encode(img, 'GIF', comment=b'x')))
+        self.assertNotEqual(first, second)
+
+
+if __name__ == '__main__':
+    unittest.main()